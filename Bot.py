@@ -3,7 +3,7 @@ Production Telegram PDF bot with converters (aiogram 3 + FastAPI webhooks)
 ----------------------------------------------------------------------------
 
 Features:
-- PDF → JPG/PNG (PyMuPDF)
+- PDF → JPG (pypdfium2)
 - PDF → DOCX/PPTX/XLSX (LibreOffice)
 - PDF → Excel tables (Camelot)
 - Split/Merge/Compress (pikepdf)
@@ -12,37 +12,64 @@ Features:
 """
 
 import asyncio
+import functools
+import io
+import itertools
 import logging
+import multiprocessing
 import os
+import re
 import tempfile
-from contextlib import asynccontextmanager
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, asynccontextmanager, contextmanager
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.filters import CommandStart, StateFilter
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import FSInputFile, Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import (BufferedInputFile, FSInputFile, InputMediaDocument, Message,
+                           InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery)
 
+import aiohttp
+import orjson
 import redis.asyncio as aioredis
-import fitz  # PyMuPDF
+import pypdfium2 as pdfium
 import subprocess
-import camelot
 import pikepdf
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
 import shutil
 import zipfile
 
+# Optional heavy backends, resolved once at startup so the first user does not
+# pay pandas/OpenCV import time and handlers only test a module global.
+try:
+    import camelot
+    from openpyxl import Workbook
+except ImportError:
+    camelot = None
+try:
+    from unoserver.client import UnoClient
+except ImportError:
+    UnoClient = None
+
 # --------------------------
 # Config
 # --------------------------
@@ -57,8 +84,31 @@ class Settings:
     redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
     max_concurrent_jobs: int = int(os.getenv("MAX_CONCURRENT_JOBS", "6"))
     max_file_mb: int = int(os.getenv("MAX_FILE_MB", "50"))
+    max_pages: int = int(os.getenv("MAX_PAGES", "500"))
     job_timeout_s: int = int(os.getenv("JOB_TIMEOUT_S", "300"))
     temp_dir: str = os.getenv("TEMP_DIR", tempfile.gettempdir())
+    work_dir: str = os.getenv("WORK_DIR", "/dev/shm/pdfbot")
+    cpu_workers: int = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 1)))
+    render_max_inflight: int = int(os.getenv("RENDER_MAX_INFLIGHT", "32"))
+    render_chunk_pages: int = int(os.getenv("RENDER_CHUNK_PAGES", "4"))
+    lo_workers: int = int(os.getenv("LO_WORKERS", "2"))
+    uno_base_port: int = int(os.getenv("UNO_BASE_PORT", "2002"))
+    # interpreter that can import both uno and unoserver (LibreOffice's own
+    # python, or a system python3 with python3-uno); empty: use the unoserver
+    # script from $PATH
+    unoserver_python: str = os.getenv("UNOSERVER_PYTHON", "")
+    ocr_workers: int = int(os.getenv("OCR_WORKERS", "1"))
+    max_render_jobs: int = int(os.getenv("MAX_RENDER_JOBS", str(max(1, (os.cpu_count() or 1) // 2))))
+    max_concurrent_uploads: int = int(os.getenv("MAX_CONCURRENT_UPLOADS", "4"))
+    download_parts: int = int(os.getenv("DOWNLOAD_PARTS", "4"))
+    max_download_connections: int = int(os.getenv("MAX_DOWNLOAD_CONNECTIONS", "8"))
+    parallel_download_min_mb: int = int(os.getenv("PARALLEL_DOWNLOAD_MIN_MB", "8"))
+    compress_jpeg_quality: int = int(os.getenv("COMPRESS_JPEG_QUALITY", "70"))
+    split_in_memory_mb: int = int(os.getenv("SPLIT_IN_MEMORY_MB", "20"))
+    pdf_cache_ttl_s: int = int(os.getenv("PDF_CACHE_TTL_S", "600"))
+    reaper_interval_s: int = int(os.getenv("REAPER_INTERVAL_S", "300"))
+    tables_chunk_pages: int = int(os.getenv("TABLES_CHUNK_PAGES", "5"))
+    tables_min_accuracy: float = float(os.getenv("TABLES_MIN_ACCURACY", "80"))
 
 SET = Settings()
 logging.basicConfig(level=logging.INFO)
@@ -69,6 +119,8 @@ if not SET.token:
 
 router = Router()
 redis_pool: Optional[aioredis.Redis] = None
+cpu_pool: Optional[ProcessPoolExecutor] = None
+lo_servers: dict[int, asyncio.subprocess.Process] = {}
 
 storage = RedisStorage.from_url(SET.redis_url)
 bot = Bot(token=SET.token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
@@ -77,23 +129,323 @@ dp.include_router(router)
 
 JOB_SEMAPHORE = asyncio.Semaphore(SET.max_concurrent_jobs)
 
+def find_bin(*names: str) -> str:
+    for name in names:
+        path = shutil.which(name)
+        if path:
+            return path
+    return names[0]
+
+# resolved once instead of a $PATH walk on every exec
+SOFFICE_BIN = find_bin("libreoffice", "soffice")
+OCRMYPDF_BIN = find_bin("ocrmypdf")
+def find_unoserver() -> Optional[list[str]]:
+    # None when no listener can be started at all; conversions then always
+    # cold-start soffice
+    if SET.unoserver_python:
+        return [SET.unoserver_python, "-m", "unoserver.server"]
+    path = shutil.which("unoserver")
+    return [path] if path else None
+
+UNOSERVER_CMD = find_unoserver()
+
+# Pool of warm LibreOffice instances. Slot i is an unoserver listening on
+# UNO_BASE_PORT + 2i (UNO) and + 2i + 1 (XML-RPC) with its own profile, since
+# soffice runs sharing a profile silently drop output. Every conversion
+# borrows a slot, which also caps how many conversions run at once.
+LO_SLOTS: "asyncio.Queue[int]" = asyncio.Queue()
+for _i in range(SET.lo_workers):
+    LO_SLOTS.put_nowait(_i)
+
+# a server that cannot import uno exits right away; anything still up after
+# this long is taken to be a working listener
+LO_STARTUP_GRACE_S = 2
+
+def lo_profile(slot: int, name: str = "server") -> Path:
+    return Path(SET.temp_dir) / f"lo_profile_{slot}_{name}"
+
+async def start_lo_server(slot: int) -> Optional[asyncio.subprocess.Process]:
+    try:
+        return await asyncio.create_subprocess_exec(
+            *UNOSERVER_CMD,
+            "--executable", SOFFICE_BIN,
+            "--uno-port", str(SET.uno_base_port + 2 * slot),
+            "--port", str(SET.uno_base_port + 2 * slot + 1),
+            "--user-installation", str(lo_profile(slot)),
+        )
+    except OSError:
+        log.warning("cannot start unoserver for slot %d", slot, exc_info=True)
+        return None
+
+# pool-backed jobs (render/split/compress/watermark/tables) each hold pages in
+# RAM on both sides of the process pool; bound how many run at once
+RENDER_SEMAPHORE = asyncio.Semaphore(SET.max_render_jobs)
+# ocrmypdf already fans out over every core with --jobs
+OCR_SEMAPHORE = asyncio.Semaphore(SET.ocr_workers)
+# bot-wide cap on in-flight Bot API uploads, well under the ~30 req/s limit
+UPLOAD_SEMAPHORE = asyncio.Semaphore(SET.max_concurrent_uploads)
+# bot-wide cap on open file download connections (ranged parts included),
+# so an album of big files cannot trip FLOOD_WAIT
+DOWNLOAD_SEMAPHORE = asyncio.Semaphore(SET.max_download_connections)
+
 # --------------------------
 # Utils
 # --------------------------
 async def run_blocking(func, *args, **kwargs):
     return await asyncio.to_thread(func, *args, **kwargs)
 
-@asynccontextmanager
-async def temp_file(suffix: str = ""):
-    fd, path = tempfile.mkstemp(suffix=suffix, dir=SET.temp_dir)
-    os.close(fd)
+async def run_subprocess(*cmd: str, env: Optional[dict] = None):
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+
+def new_cpu_pool() -> ProcessPoolExecutor:
+    # workers are started lazily from threads while the loop and to_thread
+    # workers are running; forking that state is unsafe, forkserver is not
+    return ProcessPoolExecutor(max_workers=SET.cpu_workers, mp_context=multiprocessing.get_context("forkserver"))
+
+_POOL_LOCK = threading.Lock()
+
+@contextmanager
+def cpu_pool_guard():
+    # a worker killed mid-job (native crash, OOM killer) breaks the whole
+    # executor for good: fail only the job that saw it and swap in a fresh
+    # pool for everyone after. Only the first job to notice replaces it
+    global cpu_pool
+    pool = cpu_pool
+    try:
+        yield pool
+    except BrokenProcessPool:
+        with _POOL_LOCK:
+            if cpu_pool is pool:
+                log.error("cpu pool broken, starting a new one")
+                cpu_pool = new_cpu_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+async def run_cpu(func, *args, **kwargs):
+    # GIL-bound work goes to worker processes; args must be picklable
+    loop = asyncio.get_running_loop()
+    with cpu_pool_guard() as pool:
+        return await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+
+# disk-backed counterpart of work_dir; temp_dir itself may be shared with
+# other programs, so the bot keeps its files in a subdir it owns
+SPILL_DIR = os.path.join(SET.temp_dir, "pdfbot")
+
+def work_dir_for(size: int) -> str:
+    # tmpfs turns writes into RAM stores; anything that would take more than
+    # half of what is left there goes to the disk-backed spill dir instead
     try:
-        yield Path(path)
+        st = os.statvfs(SET.work_dir)
+    except OSError:
+        return SPILL_DIR
+    return SET.work_dir if size <= st.f_bavail * st.f_frsize // 2 else SPILL_DIR
+
+# removal of per-request dirs happens off the reply path; the set keeps the
+# tasks referenced until they finish
+_BACKGROUND: set[asyncio.Task] = set()
+
+def discard(path: str):
+    task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, path, True))
+    _BACKGROUND.add(task)
+    task.add_done_callback(_BACKGROUND.discard)
+
+_FNAME_RE = re.compile(r"[^\w .\-()]")
+
+def sanitize_filename(name: str) -> str:
+    return _FNAME_RE.sub("_", os.path.basename(name))[:120]
+
+RANGED_WRITE_BYTES = 1024 * 1024  # network chunks are batched up to this per pwrite
+
+async def download_ranged(file_path: str, dest: str, size: int) -> bool:
+    # fetch DOWNLOAD_PARTS byte ranges concurrently into a preallocated file;
+    # returns False (leaving dest unspecified) if the server ignores Range
+    url = bot.session.api.file_url(bot.token, file_path)
+    session = await bot.session.create_session()
+    step = -(-size // SET.download_parts)
+    loop = asyncio.get_running_loop()
+    # big files are the ones that end up on the disk-backed spill dir: keep
+    # fallocate/pwrite off the loop on one writer thread per download
+    writer = ThreadPoolExecutor(max_workers=1)
+
+    async def fetch(start: int) -> bool:
+        end = min(start + step, size) - 1
+        async with DOWNLOAD_SEMAPHORE, session.get(url, headers={"Range": f"bytes={start}-{end}"}) as resp:
+            resp.raise_for_status()
+            if resp.status != 206:
+                return False
+            offset, buf = start, bytearray()
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                buf += chunk
+                if len(buf) >= RANGED_WRITE_BYTES:
+                    data, buf = buf, bytearray()
+                    await loop.run_in_executor(writer, os.pwrite, fd, data, offset)
+                    offset += len(data)
+            if buf:
+                await loop.run_in_executor(writer, os.pwrite, fd, buf, offset)
+        return True
+
+    fd = os.open(dest, os.O_WRONLY)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            await loop.run_in_executor(writer, os.posix_fallocate, fd, 0, size)
+        # a TaskGroup cancels and awaits the other parts when one fails
+        async with asyncio.TaskGroup() as tg:
+            parts = [tg.create_task(fetch(start)) for start in range(0, size, step)]
+        return all(part.result() for part in parts)
     finally:
+        # writes already handed to the thread by cancelled parts must land
+        # before fd is closed (and maybe reused)
+        await asyncio.to_thread(writer.shutdown)
+        os.close(fd)
+
+async def resolve_file_path(f: dict) -> str:
+    # Bot API download paths stay valid for about an hour; keep them a bit
+    # less so a re-sent file skips the getFile round trip
+    key = f"file_path:{f['file_unique_id']}"
+    file_path = await redis_pool.get(key)
+    if not file_path:
+        file_path = (await bot.get_file(f["file_id"])).file_path
+        await redis_pool.set(key, file_path, ex=3000)
+    return file_path
+
+async def fetch_pdf(f: dict) -> Path:
+    # f holds the document's file_id, file_unique_id and file_size as kept in
+    # FSM data. file_unique_id is stable across users and bots, so the local
+    # copy is effectively content-addressed and shared by everyone sending it
+    key = f"pdf:{f['file_unique_id']}"
+    cached = await redis_pool.get(key)
+    path = None
+    if cached:
         try:
-            os.remove(path)
+            os.utime(cached)  # keep the reaper off a file that is in use again
+            path = Path(cached)
         except FileNotFoundError:
-            pass
+            pass  # reaped in the meantime: treat as a miss
+    if path is None:
+        path = Path(work_dir_for(f["file_size"] or 0)) / f"{f['file_unique_id']}.pdf"
+        file_path = await resolve_file_path(f)
+        # aiogram streams path destinations through aiofiles, so the write
+        # itself stays off the loop; download under a private name and
+        # rename so concurrent senders never see a half-written file
+        fd, part = tempfile.mkstemp(suffix=".part", dir=path.parent)
+        os.close(fd)
+        try:
+            size = f["file_size"] or 0
+            ranged = (
+                SET.download_parts > 1
+                and size >= SET.parallel_download_min_mb * 1024 * 1024
+                and await download_ranged(file_path, part, size)
+            )
+            if not ranged:
+                async with DOWNLOAD_SEMAPHORE:
+                    await bot.download_file(file_path, destination=part)
+            os.replace(part, path)
+        except BaseException:
+            os.remove(part)
+            raise
+    await redis_pool.set(key, str(path), ex=SET.pdf_cache_ttl_s)
+    return path
+
+UPLOAD_ATTEMPTS = 3
+
+# cached inputs outlive their Redis key, crashed downloads leave .part files
+# and a crashed worker leaves its request dirs; sweep all three periodically.
+# Only the bot's own dirs are scanned
+REAP_SUFFIXES = (".pdf", ".part")
+REQUEST_DIR_PREFIX = "req-"
+
+# inputs and request dirs held by this worker's jobs, however long they queue
+# or run; the reaper skips them. Other workers are covered by the age cutoff
+_IN_USE: Counter = Counter()
+
+@contextmanager
+def in_use(path):
+    path = os.path.abspath(path)
+    _IN_USE[path] += 1
+    try:
+        yield
+    finally:
+        _IN_USE[path] -= 1
+        if not _IN_USE[path]:
+            del _IN_USE[path]
+
+def _newest_mtime(path: str) -> float:
+    newest = os.stat(path).st_mtime
+    with os.scandir(path) as it:
+        for entry in it:
+            newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+    return newest
+
+def reap_stale(max_age: float, busy: frozenset = frozenset()) -> int:
+    cutoff = time.time() - max_age
+    removed = 0
+    for root in {os.path.abspath(SET.work_dir), os.path.abspath(SPILL_DIR)}:
+        try:
+            it = os.scandir(root)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.path in busy:
+                    continue
+                try:
+                    if entry.name.endswith(REAP_SUFFIXES) and entry.is_file(follow_symlinks=False):
+                        if entry.stat().st_mtime < cutoff:
+                            os.unlink(entry.path)
+                            removed += 1
+                    elif entry.name.startswith(REQUEST_DIR_PREFIX) and entry.is_dir(follow_symlinks=False):
+                        if _newest_mtime(entry.path) < cutoff:
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                            removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+async def reaper():
+    # twice the cache TTL past the last touch; paths held by our own jobs are
+    # skipped outright
+    while True:
+        await asyncio.sleep(SET.reaper_interval_s)
+        try:
+            removed = await run_blocking(reap_stale, 2 * SET.pdf_cache_ttl_s, frozenset(_IN_USE))
+        except OSError:
+            log.exception("reaper failed")
+            continue
+        if removed:
+            log.info("reaper removed %d stale files", removed)
+
+async def with_retries(method, *args, **kwargs):
+    # every upload goes through here, so this is where the bot-wide cap is
+    # taken; it is released while backing off.
+    # 429s wait as long as Telegram asks; network flakes back off 1s, 2s, ...
+    for attempt in range(UPLOAD_ATTEMPTS):
+        try:
+            async with UPLOAD_SEMAPHORE:
+                return await method(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt == UPLOAD_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(e.retry_after)
+        except TelegramNetworkError:
+            if attempt == UPLOAD_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+MEDIA_GROUP_MAX = 10  # Bot API limit per sendMediaGroup call
+
+async def answer_files(message: Message, files: list[tuple[str, bytes]]):
+    # media groups need 2..MEDIA_GROUP_MAX items; a lone file goes as a plain document
+    if len(files) == 1:
+        name, data = files[0]
+        await with_retries(message.answer_document, BufferedInputFile(data, name))
+    else:
+        media = [InputMediaDocument(media=BufferedInputFile(data, name)) for name, data in files]
+        await with_retries(message.answer_media_group, media)
 
 # --------------------------
 # FSM
@@ -105,170 +457,528 @@ class PDFStates(StatesGroup):
 # --------------------------
 # PDF Operations
 # --------------------------
-def pdf_to_jpg(src: Path, dst_dir: Path):
-    doc = fitz.open(src)
-    dst_dir.mkdir(parents=True, exist_ok=True)
-    out_files = []
-    for i, page in enumerate(doc):
-        pix = page.get_pixmap(dpi=150)
-        out_path = dst_dir / f"page_{i+1}.jpg"
-        pix.save(out_path)
-        out_files.append(out_path)
-    return out_files
-
-def pdf_to_docx(src: Path, dst: Path):
-    subprocess.run(["libreoffice", "--headless", "--convert-to", "docx", str(src), "--outdir", str(dst.parent)], check=True)
-    return dst
+def _render_pages(src: Path, start: int, stop: int, dpi: int) -> list[bytes]:
+    # runs in a worker process: each worker opens its own PdfDocument once
+    # per page range, pdfium handles must not be shared across processes
+    pdf = pdfium.PdfDocument(src)
+    try:
+        out = []
+        for index in range(start, stop):
+            bitmap = pdf[index].render(scale=dpi / 72)
+            buf = io.BytesIO()
+            bitmap.to_pil().save(buf, "JPEG", quality=85)
+            out.append(buf.getvalue())
+        return out
+    finally:
+        pdf.close()
+
+def pdf_bytes(build, src: Path, *args) -> bytes:
+    # runs in a worker process: build saves straight into a buffer, so the
+    # result never touches disk
+    buf = io.BytesIO()
+    build(src, buf, *args)
+    return buf.getvalue()
+
+def pdf_to_jpg(src: Path, dpi: int = 150, page_count: Optional[int] = None):
+    # fans pages out to cpu_pool and yields (name, jpeg bytes) in page order;
+    # rendering keeps running ahead while the consumer uploads
+    if page_count is None:
+        pdf = pdfium.PdfDocument(src)
+        page_count = len(pdf)
+        pdf.close()
+
+    def drain():
+        start, fut = pending.popleft()
+        for offset, jpeg in enumerate(fut.result()):
+            yield f"page_{start + offset + 1}.jpg", jpeg
+
+    step = SET.render_chunk_pages
+    max_chunks = max(1, SET.render_max_inflight // step)
+    pending = deque()
+    try:
+        with cpu_pool_guard() as pool:
+            for start in range(0, page_count, step):
+                # backpressure: never keep more than render_max_inflight pages queued
+                if len(pending) >= max_chunks:
+                    yield from drain()
+                pending.append((start, pool.submit(_render_pages, src, start, min(start + step, page_count), dpi)))
+            while pending:
+                yield from drain()
+    finally:
+        # consumer gave up (upload failed, generator closed): free the pool
+        # of chunks nobody will read; ones already rendering just finish
+        for _, fut in pending:
+            fut.cancel()
 
-def pdf_to_pptx(src: Path, dst: Path):
-    subprocess.run(["libreoffice", "--headless", "--convert-to", "pptx", str(src), "--outdir", str(dst.parent)], check=True)
-    return dst
+def pdf_page_count(src: Path) -> int:
+    with pikepdf.open(src, access_mode=pikepdf.AccessMode.mmap) as pdf:
+        return len(pdf.pages)
 
-def pdf_to_xlsx(src: Path, dst: Path):
-    subprocess.run(["libreoffice", "--headless", "--convert-to", "xlsx", str(src), "--outdir", str(dst.parent)], check=True)
+async def libreoffice_convert(src: Path, dst: Path, fmt: str):
+    slot = await LO_SLOTS.get()
+    try:
+        try:
+            if slot not in lo_servers:
+                raise ConnectionRefusedError("no unoserver for this slot")
+            client = UnoClient(port=str(SET.uno_base_port + 2 * slot + 1))
+            await run_blocking(client.convert, inpath=str(src), outpath=str(dst), convert_to=fmt)
+        except ConnectionRefusedError:
+            # no listener (unavailable, starting up or gone): cold-start a
+            # one-off soffice on a separate profile so it cannot clash with
+            # the server's lock
+            proc = lo_servers.get(slot)
+            if proc is not None:
+                log.warning("unoserver slot %d unavailable, falling back to soffice", slot)
+                if proc.returncode is not None:
+                    # died after a good start (crash, OOM kill): bring it back
+                    # for later conversions; the slot is ours, so no race
+                    log.warning("unoserver slot %d exited with %s, restarting", slot, proc.returncode)
+                    proc = await start_lo_server(slot)
+                    if proc is None:
+                        del lo_servers[slot]
+                    else:
+                        lo_servers[slot] = proc
+            await run_subprocess(
+                SOFFICE_BIN, f"-env:UserInstallation={lo_profile(slot, 'cli').as_uri()}", "--headless",
+                "--convert-to", fmt, str(src), "--outdir", str(dst.parent),
+            )
+    finally:
+        LO_SLOTS.put_nowait(slot)
     return dst
 
+async def pdf_to_docx(src: Path, dst: Path):
+    return await libreoffice_convert(src, dst, "docx")
+
+async def pdf_to_pptx(src: Path, dst: Path):
+    return await libreoffice_convert(src, dst, "pptx")
+
+async def pdf_to_xlsx(src: Path, dst: Path):
+    return await libreoffice_convert(src, dst, "xlsx")
+
+def _text_pages(src: Path) -> list[int]:
+    # pages without a text layer cannot hold stream-detectable tables
+    pdf = pdfium.PdfDocument(src)
+    try:
+        return [i + 1 for i in range(len(pdf)) if pdf[i].get_textpage().count_chars()]
+    finally:
+        pdf.close()
+
+def _read_tables(src: Path, pages: str) -> list[tuple[int, int, list[list[str]]]]:
+    # runs in a worker process: cheap stream parse first, lattice only for
+    # the pages where stream guessed badly. Only (page, order, rows) goes
+    # back through the pool; Table objects drag images and pdfminer state
+    tables = list(camelot.read_pdf(str(src), pages=pages, flavor="stream"))
+    weak = sorted({t.page for t in tables if t.accuracy < SET.tables_min_accuracy}, key=int)
+    if weak:
+        tables = [t for t in tables if t.page not in weak]
+        tables.extend(camelot.read_pdf(str(src), pages=",".join(weak), flavor="lattice"))
+    # lattice re-reads land after the stream tables; chunks are consecutive
+    # page ranges, so ordering within the chunk keeps the workbook in order
+    return sorted((int(t.page), t.order, t.df.values.tolist()) for t in tables)
+
 def pdf_tables_to_excel(src: Path, dst: Path):
-    tables = camelot.read_pdf(str(src), pages="all")
-    tables.export(str(dst), f="excel")
+    # runs on a thread: fans page chunks out to cpu_pool
+    if camelot is None:
+        raise RuntimeError("camelot-py is not installed")
+    pages = _text_pages(src)
+    step = SET.tables_chunk_pages
+    chunks = [",".join(map(str, pages[i:i + step])) for i in range(0, len(pages), step)]
+    # write-only workbook streams rows straight out instead of going
+    # through pandas.ExcelWriter and a DataFrame per sheet
+    wb = Workbook(write_only=True)
+    with cpu_pool_guard() as pool:
+        futures = [pool.submit(_read_tables, src, chunk) for chunk in chunks]
+        for fut in futures:
+            for page, order, rows in fut.result():
+                ws = wb.create_sheet(f"page-{page}-table-{order}")
+                for row in rows:
+                    ws.append(row)
+    if not wb.worksheets:
+        # a workbook needs at least one sheet even when no table was found
+        wb.create_sheet("tables")
+    wb.save(dst)
     return dst
 
+# qpdf only writes reachable objects, so this is pikepdf's counterpart of
+# fitz's garbage/deflate/use_objstms output tuning; existing streams are
+# copied through still encoded instead of being inflated and re-deflated
+SAVE_OPTS = dict(
+    compress_streams=True,
+    object_stream_mode=pikepdf.ObjectStreamMode.generate,
+    stream_decode_level=pikepdf.StreamDecodeLevel.none,
+)
+
 def pdf_merge(files: list[Path], dst: Path):
-    pdf = pikepdf.Pdf.new()
-    for f in files:
-        pdf.pages.extend(pikepdf.Pdf.open(f).pages)
-    pdf.save(dst)
+    # sources must stay open until save: pikepdf copies page objects lazily
+    with ExitStack() as stack, pikepdf.Pdf.new() as pdf:
+        for f in files:
+            src = stack.enter_context(pikepdf.open(f, access_mode=pikepdf.AccessMode.mmap))
+            pdf.pages.extend(src.pages)
+        pdf.save(dst, **SAVE_OPTS)
     return dst
 
-def pdf_split(src: Path, dst_dir: Path):
-    pdf = pikepdf.Pdf.open(src)
-    outputs = []
-    for i, page in enumerate(pdf.pages):
-        new_pdf = pikepdf.Pdf.new()
-        new_pdf.pages.append(page)
-        out_path = dst_dir / f"page_{i+1}.pdf"
-        new_pdf.save(out_path)
-        outputs.append(out_path)
-    return outputs
-
-def pdf_compress(src: Path, dst: Path):
-    pdf = pikepdf.open(src)
-    pdf.save(dst, compress_streams=True)
+def pdf_split(src: Path, dst):
+    # small inputs are split entirely in memory; big ones reuse a single
+    # spill file so per-page buffers cannot blow up RAM
+    in_memory = src.stat().st_size <= SET.split_in_memory_mb * 1024 * 1024
+    spill = None
+    if not in_memory:
+        fd, spill = tempfile.mkstemp(suffix=".pdf", dir=work_dir_for(src.stat().st_size))
+        os.close(fd)
+    try:
+        # pikepdf compresses the page streams already, deflating them again is wasted CPU
+        with pikepdf.open(src, access_mode=pikepdf.AccessMode.mmap) as pdf, \
+                zipfile.ZipFile(dst, "w", compression=zipfile.ZIP_STORED) as zf:
+            for i, page in enumerate(pdf.pages):
+                new_pdf = pikepdf.Pdf.new()
+                new_pdf.pages.append(page)
+                name = f"page_{i+1}.pdf"
+                if in_memory:
+                    buf = io.BytesIO()
+                    new_pdf.save(buf, **SAVE_OPTS)
+                    zf.writestr(name, buf.getvalue())
+                else:
+                    new_pdf.save(spill, **SAVE_OPTS)
+                    zf.write(spill, arcname=name)
+        return dst
+    finally:
+        if spill:
+            os.remove(spill)
+
+def _recompress_images(pdf: pikepdf.Pdf, quality: int):
+    # squeeze only the embedded rasters; text and vector content stay intact
+    seen = set()
+    for page in pdf.pages:
+        for raw in page.images.values():
+            if raw.objgen in seen or raw.get("/ImageMask"):
+                continue
+            seen.add(raw.objgen)
+            try:
+                pil = pikepdf.PdfImage(raw).as_pil_image()
+            except Exception:
+                # exotic colourspace/filter pikepdf cannot decode: leave as is
+                continue
+            if pil.mode not in ("RGB", "L"):
+                pil = pil.convert("RGB")
+            buf = io.BytesIO()
+            pil.save(buf, "JPEG", quality=quality, optimize=True)
+            if buf.tell() >= len(raw.read_raw_bytes()):
+                continue
+            raw.write(buf.getvalue(), filter=pikepdf.Name.DCTDecode)
+            raw.ColorSpace = pikepdf.Name.DeviceRGB if pil.mode == "RGB" else pikepdf.Name.DeviceGray
+            raw.BitsPerComponent = 8
+            for key in ("/DecodeParms", "/Decode"):
+                if key in raw:
+                    del raw[key]
+
+def pdf_compress(src: Path, dst, level: str = "max"):
+    # "fast" only packs objects into object streams; "max" also re-encodes
+    # embedded images as JPEG and re-deflates every generalized-filter stream
+    opts = dict(SAVE_OPTS, linearize=False)
+    if level == "max":
+        opts.update(recompress_flate=True, stream_decode_level=pikepdf.StreamDecodeLevel.generalized)
+    with pikepdf.open(src, access_mode=pikepdf.AccessMode.mmap) as pdf:
+        if level == "max":
+            _recompress_images(pdf, SET.compress_jpeg_quality)
+        pdf.save(dst, **opts)
     return dst
 
-def pdf_watermark(src: Path, dst: Path, text: str = "WATERMARK"):
-    wm_pdf = dst.parent / "wm.pdf"
-    c = canvas.Canvas(str(wm_pdf), pagesize=letter)
-    c.setFont("Helvetica", 40)
-    c.setFillGray(0.5, 0.5)
-    c.saveState()
-    c.translate(300, 400)
-    c.rotate(45)
-    c.drawString(0, 0, text)
-    c.restoreState()
-    c.save()
-    base = pikepdf.open(src)
-    wm = pikepdf.open(wm_pdf)
-    for page in base.pages:
-        page_obj = page.as_form_xobject()
-        page_obj.add_overlay(wm.pages[0])
-    base.save(dst)
+FONT_PATH = Path(__file__).resolve().parent / "fonts" / "arialmt.ttf"
+# parsed once per process; the TTF also covers Cyrillic, which Helvetica lacks
+if "CustomFont" not in pdfmetrics.getRegisteredFontNames():
+    pdfmetrics.registerFont(TTFont("CustomFont", str(FONT_PATH)))
+
+# text -> (overlay Pdf, its page as a form XObject); the Pdf must stay open
+# for as long as the XObject that lives inside it is used
+_WM_CACHE: dict[str, tuple[pikepdf.Pdf, pikepdf.Object]] = {}
+
+def _watermark_overlay(text: str) -> pikepdf.Object:
+    cached = _WM_CACHE.get(text)
+    if cached is None:
+        buf = io.BytesIO()
+        c = canvas.Canvas(buf, pagesize=letter)
+        c.setFont("CustomFont", 40)
+        c.setFillGray(0.5, 0.5)
+        c.saveState()
+        c.translate(300, 400)
+        c.rotate(45)
+        c.drawString(0, 0, text)
+        c.restoreState()
+        c.save()
+        buf.seek(0)
+        wm = pikepdf.open(buf)
+        # as_form_xobject adds a new stream to wm on every call: build it once
+        cached = _WM_CACHE[text] = (wm, wm.pages[0].as_form_xobject())
+    return cached[1]
+
+def pdf_watermark(src: Path, dst, text: str = "WATERMARK"):
+    form = _watermark_overlay(text)
+    with pikepdf.open(src, access_mode=pikepdf.AccessMode.mmap) as base:
+        # copy the overlay into the target once and reference it from every page
+        overlay = base.copy_foreign(form)
+        for page in base.pages:
+            page.add_overlay(overlay)
+        base.save(dst, **SAVE_OPTS)
     return dst
 
-def pdf_ocr(src: Path, dst: Path):
-    subprocess.run(["ocrmypdf", str(src), str(dst)], check=True)
+# the handler always stamps "BOT": render it once at import time
+_watermark_overlay("BOT")
+
+async def pdf_ocr(src: Path, dst: Path, redo: bool = False):
+    # --skip-text leaves pages that already have a text layer alone;
+    # --redo-ocr replaces existing OCR for the thorough mode
+    async with OCR_SEMAPHORE:
+        await run_subprocess(
+            OCRMYPDF_BIN, "--redo-ocr" if redo else "--skip-text", "--jobs", str(os.cpu_count() or 1),
+            "--output-type", "pdf", "--optimize", "0", str(src), str(dst),
+            env={**os.environ, "TMPDIR": SET.temp_dir},
+        )
     return dst
 
 # --------------------------
 # Handlers
 # --------------------------
+# built once: markups are immutable and would otherwise be re-validated per message
+ACTION_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="PDF→DOCX", callback_data="to_docx"),
+     InlineKeyboardButton(text="PDF→PPTX", callback_data="to_pptx")],
+    [InlineKeyboardButton(text="PDF→XLSX", callback_data="to_xlsx"),
+     InlineKeyboardButton(text="PDF→JPG", callback_data="to_jpg")],
+    [InlineKeyboardButton(text="Split", callback_data="split"),
+     InlineKeyboardButton(text="Compress", callback_data="compress")],
+    [InlineKeyboardButton(text="Watermark", callback_data="watermark"),
+     InlineKeyboardButton(text="OCR", callback_data="ocr")],
+    [InlineKeyboardButton(text="OCR (заново)", callback_data="ocr_redo")]
+    + ([InlineKeyboardButton(text="Таблицы→Excel", callback_data="tables")] if camelot else []),
+])
+
 @router.message(CommandStart())
 async def on_start(message: Message, state: FSMContext):
     await message.answer("👋 Привет! Пришли PDF для обработки.")
     await state.set_state(PDFStates.waiting_file)
 
-@router.message(PDFStates.waiting_file, F.document)
-async def on_file(message: Message, state: FSMContext):
-    if not message.document.file_name.endswith(".pdf"):
+async def prepare_file(message: Message) -> Optional[dict]:
+    # validate, fetch and pre-flight one document; None if it was rejected
+    document = message.document
+    if not (document.file_name or "").lower().endswith(".pdf"):
         await message.answer("⚠️ Пожалуйста, отправь PDF файл.")
+        return None
+    if (document.file_size or 0) > SET.max_file_mb * 1024 * 1024:
+        await message.answer(f"⚠️ Файл больше {SET.max_file_mb} МБ.")
+        return None
+    # ids are kept so on_action can fetch the file again if the cached copy
+    # expired while the user was choosing
+    f = {
+        "file_id": document.file_id,
+        "file_unique_id": document.file_unique_id,
+        "file_size": document.file_size,
+        "stem": sanitize_filename(Path(document.file_name).stem),
+    }
+    # reject early, before the user is offered any work to queue
+    try:
+        pdf_path = await fetch_pdf(f)
+    except (TelegramAPIError, aiohttp.ClientError, OSError):
+        log.exception("download failed for %s", f["stem"])
+        await message.answer("⚠️ Не удалось скачать файл, попробуй ещё раз.")
+        return None
+    # remember what the pre-flight parse learned so actions don't reparse it
+    try:
+        f["page_count"] = await run_blocking(pdf_page_count, pdf_path)
+    except pikepdf.PdfError:
+        # corrupt or password-protected (PasswordError is a PdfError)
+        await message.answer("⚠️ Не удалось открыть PDF: файл повреждён или защищён паролем.")
+        return None
+    if f["page_count"] > SET.max_pages:
+        await message.answer(f"⚠️ Слишком много страниц (максимум {SET.max_pages}).")
+        return None
+    return f
+
+# Albums arrive as one update per document, possibly on different workers
+# and after the menu already went out. Prepared files are pushed to a Redis
+# list per album (a lone document is a batch of its own); once the group has
+# been quiet for ALBUM_DEBOUNCE_S the last member to push offers the menu
+# and points batch:{chat}:{user} at its list, so late members re-offer it
+ALBUM_DEBOUNCE_S = 0.5
+BATCH_TTL_S = 3600
+
+def batch_key(state: FSMContext) -> str:
+    return f"batch:{state.key.chat_id}:{state.key.user_id}"
+
+@router.message(StateFilter(PDFStates.waiting_file, PDFStates.waiting_action), F.document)
+async def on_file(message: Message, state: FSMContext):
+    try:
+        f = await prepare_file(message)
+    except Exception:
+        # one bad document must not take the rest of its album down silently
+        name = sanitize_filename(message.document.file_name or "PDF")
+        log.exception("preparing %s failed", name)
+        await message.answer(f"⚠️ Не удалось обработать {name}.")
+        return
+    if f is None:
         return
 
-    file = await bot.get_file(message.document.file_id)
-    async with temp_file(suffix=".pdf") as pdf_path:
-        await bot.download_file(file.file_path, destination=str(pdf_path))
-        await state.update_data(pdf_path=str(pdf_path))
-
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="PDF→DOCX", callback_data="to_docx"),
-             InlineKeyboardButton(text="PDF→PPTX", callback_data="to_pptx")],
-            [InlineKeyboardButton(text="PDF→XLSX", callback_data="to_xlsx"),
-             InlineKeyboardButton(text="PDF→JPG", callback_data="to_jpg")],
-            [InlineKeyboardButton(text="Split", callback_data="split"),
-             InlineKeyboardButton(text="Compress", callback_data="compress")],
-            [InlineKeyboardButton(text="Watermark", callback_data="watermark"),
-             InlineKeyboardButton(text="OCR", callback_data="ocr")],
-        ])
-        await message.answer("Выберите действие:", reply_markup=kb)
-        await state.set_state(PDFStates.waiting_action)
+    key = batch_key(state)
+    group_key = f"{key}:{message.media_group_id or f'msg:{message.message_id}'}"
+    async with redis_pool.pipeline(transaction=True) as pipe:
+        pipe.rpush(group_key, orjson.dumps(f))
+        pipe.expire(group_key, BATCH_TTL_S)
+        count, _ = await pipe.execute()
+    if message.media_group_id:
+        await asyncio.sleep(ALBUM_DEBOUNCE_S)
+        if await redis_pool.llen(group_key) != count:
+            return  # a later member pushed and will offer the menu
+    await redis_pool.set(key, group_key, ex=BATCH_TTL_S)
+
+    text = "Выберите действие:" if count == 1 else f"Файлов: {count}. Выберите действие:"
+    await message.answer(text, reply_markup=ACTION_KB)
+    await state.set_state(PDFStates.waiting_action)
+
+def file_action(func, suffix: str, caption: str, runner=None, *args):
+    # actions that write one output file next to the input and send it back;
+    # without a runner func is a coroutine function awaited directly
+    async def action(message: Message, pdf_path: Path, data: dict):
+        # a private dir per request: the cached input is shared between
+        # users, so outputs must not sit next to it, and leave nothing behind
+        tmp = tempfile.mkdtemp(prefix=REQUEST_DIR_PREFIX, dir=work_dir_for(pdf_path.stat().st_size))
+        try:
+            with in_use(tmp):
+                out = Path(tmp) / (pdf_path.stem + suffix)
+                if runner is None:
+                    await func(pdf_path, out, *args)
+                else:
+                    await runner(func, pdf_path, out, *args)
+                filename = data.get("stem", pdf_path.stem) + suffix
+                await with_retries(message.answer_document, FSInputFile(out, filename=filename), caption=caption)
+        finally:
+            discard(tmp)
+    return action
+
+def limited(sem: asyncio.Semaphore, action):
+    async def run(*args):
+        async with sem:
+            await action(*args)
+    return run
+
+async def jpg_action(message: Message, pdf_path: Path, data: dict):
+    pages = pdf_to_jpg(pdf_path, page_count=data.get("page_count"))
+    # collect batch N+1 while batch N uploads; groups still go out one at a
+    # time because concurrent media groups can arrive out of page order
+    upload = None
+    try:
+        while batch := await run_blocking(list, itertools.islice(pages, MEDIA_GROUP_MAX)):
+            if upload:
+                await upload
+            upload = asyncio.create_task(answer_files(message, batch))
+        if upload:
+            await upload
+    finally:
+        # on failure neither half may outlive the job: queued renders are
+        # cancelled and a pending upload is stopped and reaped
+        try:
+            pages.close()
+        except ValueError:
+            pass  # cancelled mid-batch, still running on its thread; closed once collected
+        if upload:
+            upload.cancel()
+            await asyncio.gather(upload, return_exceptions=True)
+    await message.answer("JPG готов ✅")
+
+def memory_action(func, suffix: str, caption: str, *args):
+    # pool jobs whose PDF result is built in memory (via pdf_bytes) and
+    # uploaded from there, skipping the write-then-reread of a file
+    async def action(message: Message, pdf_path: Path, data: dict):
+        payload = await run_cpu(pdf_bytes, func, pdf_path, *args)
+        filename = data.get("stem", pdf_path.stem) + suffix
+        await with_retries(message.answer_document, BufferedInputFile(payload, filename), caption=caption)
+    return action
+
+ACTIONS = {
+    # LibreOffice and OCR are bounded by LO_SLOTS / OCR_SEMAPHORE themselves
+    "to_docx": file_action(pdf_to_docx, ".docx", "DOCX готов ✅"),
+    "to_pptx": file_action(pdf_to_pptx, ".pptx", "PPTX готов ✅"),
+    "to_xlsx": file_action(pdf_to_xlsx, ".xlsx", "XLSX готов ✅"),
+    "to_jpg": limited(RENDER_SEMAPHORE, jpg_action),
+    # one-page PDFs each carry their own fonts/images, so the archive can
+    # dwarf the input: write it to the request dir and stream it from there
+    "split": limited(RENDER_SEMAPHORE, file_action(pdf_split, "_split.zip", "Разбито ✅", run_cpu)),
+    "compress": limited(RENDER_SEMAPHORE, memory_action(pdf_compress, "_compressed.pdf", "Сжатый PDF ✅")),
+    "watermark": limited(RENDER_SEMAPHORE, memory_action(pdf_watermark, "_wm.pdf", "Водяной знак ✅", "BOT")),
+    "ocr": file_action(pdf_ocr, "_ocr.pdf", "OCR PDF ✅", None, False),
+    "ocr_redo": file_action(pdf_ocr, "_ocr.pdf", "OCR PDF ✅", None, True),
+    # coordinator runs on a thread, page chunks go to cpu_pool
+    "tables": limited(RENDER_SEMAPHORE, file_action(pdf_tables_to_excel, "_tables.xlsx", "Таблицы готовы ✅", run_blocking)),
+}
 
 @router.callback_query(PDFStates.waiting_action)
 async def on_action(call: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    pdf_path = Path(data["pdf_path"])
-
-    async with JOB_SEMAPHORE:
-        if call.data == "to_docx":
-            out = pdf_path.with_suffix(".docx")
-            await run_blocking(pdf_to_docx, pdf_path, out)
-            await call.message.answer_document(FSInputFile(out), caption="DOCX готов ✅")
-        elif call.data == "to_pptx":
-            out = pdf_path.with_suffix(".pptx")
-            await run_blocking(pdf_to_pptx, pdf_path, out)
-            await call.message.answer_document(FSInputFile(out), caption="PPTX готов ✅")
-        elif call.data == "to_xlsx":
-            out = pdf_path.with_suffix(".xlsx")
-            await run_blocking(pdf_to_xlsx, pdf_path, out)
-            await call.message.answer_document(FSInputFile(out), caption="XLSX готов ✅")
-        elif call.data == "to_jpg":
-            out_dir = Path(tempfile.mkdtemp(dir=SET.temp_dir))
-            files = await run_blocking(pdf_to_jpg, pdf_path, out_dir)
-            zip_path = pdf_path.with_suffix(".zip")
-            with zipfile.ZipFile(zip_path, "w") as z:
-                for f in files:
-                    z.write(f, arcname=f.name)
-            await call.message.answer_document(FSInputFile(zip_path), caption="JPG архив готов ✅")
-        elif call.data == "split":
-            out_dir = Path(tempfile.mkdtemp(dir=SET.temp_dir))
-            files = await run_blocking(pdf_split, pdf_path, out_dir)
-            zip_path = pdf_path.with_suffix("_split.zip")
-            with zipfile.ZipFile(zip_path, "w") as z:
-                for f in files:
-                    z.write(f, arcname=f.name)
-            await call.message.answer_document(FSInputFile(zip_path), caption="Разбито ✅")
-        elif call.data == "compress":
-            out = pdf_path.with_name(pdf_path.stem + "_compressed.pdf")
-            await run_blocking(pdf_compress, pdf_path, out)
-            await call.message.answer_document(FSInputFile(out), caption="Сжатый PDF ✅")
-        elif call.data == "watermark":
-            out = pdf_path.with_name(pdf_path.stem + "_wm.pdf")
-            await run_blocking(pdf_watermark, pdf_path, out, "BOT")
-            await call.message.answer_document(FSInputFile(out), caption="Водяной знак ✅")
-        elif call.data == "ocr":
-            out = pdf_path.with_name(pdf_path.stem + "_ocr.pdf")
-            await run_blocking(pdf_ocr, pdf_path, out)
-            await call.message.answer_document(FSInputFile(out), caption="OCR PDF ✅")
+    # take the whole batch atomically; members arriving later start a new one
+    key = batch_key(state)
+    files = []
+    group_key = await redis_pool.get(key)
+    if group_key:
+        async with redis_pool.pipeline(transaction=True) as pipe:
+            pipe.lrange(group_key, 0, -1)
+            pipe.delete(group_key, key)
+            raw, _ = await pipe.execute()
+        files = [orjson.loads(item) for item in raw]
+    if not files:
+        await call.message.answer("⚠️ Файл устарел, пришли PDF ещё раз.")
+        await call.answer()
+        await state.set_state(PDFStates.waiting_file)
+        return
 
+    async def process(action, f: dict):
+        # fetch_pdf is normally a cache hit and only re-downloads an expired
+        # copy, so it runs before the job slot. Each file of a batch then takes
+        # its own slot, so MAX_CONCURRENT_JOBS holds however many files a user sends
+        pdf_path = await fetch_pdf(f)
+        # pinned from here on, so queueing or a long run cannot outlast the
+        # reaper's cutoff
+        with in_use(pdf_path):
+            async with JOB_SEMAPHORE:
+                await action(call.message, pdf_path, f)
+
+    # answer right away: the query expires long before big jobs finish
     await call.answer()
-    await state.clear()
+    action = ACTIONS.get(call.data)
+    try:
+        if action:
+            results = await asyncio.gather(*(process(action, f) for f in files), return_exceptions=True)
+            for f, result in zip(files, results):
+                if isinstance(result, Exception):
+                    log.error("%s failed for %s", call.data, f["stem"], exc_info=result)
+                    await call.message.answer(f"⚠️ Не удалось обработать {f['stem']}.")
+    finally:
+        await state.clear()
 
 # --------------------------
 # FastAPI app with lifespan
 # --------------------------
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global redis_pool
+    global redis_pool, cpu_pool
     # startup
     redis_pool = aioredis.from_url(SET.redis_url, decode_responses=True)
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    try:
+        os.makedirs(SET.work_dir, exist_ok=True)
+    except OSError:
+        log.warning("work dir %s unavailable, using %s", SET.work_dir, SPILL_DIR)
+    cpu_pool = new_cpu_pool()
+    reaper_task = asyncio.create_task(reaper())
+    if UnoClient and UNOSERVER_CMD:
+        procs = await asyncio.gather(*(start_lo_server(slot) for slot in range(SET.lo_workers)))
+        await asyncio.sleep(LO_STARTUP_GRACE_S)
+        for slot, proc in enumerate(procs):
+            if proc is None:
+                continue
+            if proc.returncode is None:
+                lo_servers[slot] = proc
+            else:
+                log.warning("unoserver slot %d exited with %s at startup, soffice will be cold-started",
+                            slot, proc.returncode)
+    else:
+        log.warning("unoserver unavailable, soffice will be cold-started per conversion")
     await bot.set_webhook(
         url=f"{SET.webhook_base.rstrip('/')}{SET.webhook_path}",
         secret_token=SET.webhook_secret or None,
@@ -276,10 +986,20 @@ async def lifespan(app: FastAPI):
     )
     yield
     # shutdown
+    reaper_task.cancel()
+    for proc in lo_servers.values():
+        if proc.returncode is None:
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+        await proc.wait()
+    if cpu_pool:
+        cpu_pool.shutdown(cancel_futures=True)
     if redis_pool:
         await redis_pool.close()
 
-app = FastAPI(title="Telegram Bot", lifespan=lifespan)
+app = FastAPI(title="Telegram Bot", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 @app.get("/healthz")
 async def healthz():
@@ -289,8 +1009,8 @@ async def healthz():
 async def telegram_webhook(request: Request):
     secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
     if SET.webhook_secret and secret != SET.webhook_secret:
-        return JSONResponse(status_code=403, content={"detail": "bad secret"})
-    data = await request.json()
+        return ORJSONResponse(status_code=403, content={"detail": "bad secret"})
+    data = orjson.loads(await request.body())
     update = dp.update_factory(data)
     await dp.feed_update(bot, update)
     return Response(status_code=200)